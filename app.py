@@ -1,24 +1,503 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
 import os
+import sys
+import hmac
+import contextvars
+import re
+import math
+import time
 import base64
+import hashlib
+import shutil
+import sqlite3
 import tempfile
+import threading
+import uuid
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, TimeoutError as FutureTimeoutError, wait
 from datetime import datetime
 from werkzeug.utils import secure_filename
 import requests
 import json
+import zipfile
+import posixpath
+import xml.etree.ElementTree as ET
+from html.parser import HTMLParser
+
+try:
+    import fitz  # PyMuPDF（PDF対応、未インストール時はPDFを受け付けない）
+except ImportError:
+    fitz = None
+
+try:
+    from PIL import Image  # Pillow（重複ページ検出、未インストール時は無効）
+except ImportError:
+    Image = None
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB max file size
 
 # Gemini API設定（環境変数から取得）
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
+GEMINI_API_BASE = os.environ.get('GEMINI_API_BASE', 'https://generativelanguage.googleapis.com/v1beta/models')
+GEMINI_REQUEST_TIMEOUT = float(os.environ.get('GEMINI_REQUEST_TIMEOUT', 120))
+
+# モデル振り分け設定（短い入力・小さい画像は軽量モデル、長い翻訳は標準モデル）
+GEMINI_MODEL_STANDARD = os.environ.get('GEMINI_MODEL_STANDARD', 'gemini-1.5-flash')
+GEMINI_MODEL_LIGHT = os.environ.get('GEMINI_MODEL_LIGHT', 'gemini-1.5-flash-8b')
+ROUTING_LIGHT_MAX_CHARS = int(os.environ.get('ROUTING_LIGHT_MAX_CHARS', 2000))
+ROUTING_LIGHT_MAX_IMAGE_BYTES = int(os.environ.get('ROUTING_LIGHT_MAX_IMAGE_BYTES', 300 * 1024))
+
+# ヘッジリクエスト設定（遅い応答に備えて別モデル・別エンドポイントへ重複送信）
+GEMINI_HEDGE_ENABLED = os.environ.get('GEMINI_HEDGE_ENABLED', 'false').lower() == 'true'
+GEMINI_HEDGE_MODEL = os.environ.get('GEMINI_HEDGE_MODEL')
+GEMINI_HEDGE_API_BASE = os.environ.get('GEMINI_HEDGE_API_BASE', GEMINI_API_BASE)
+GEMINI_HEDGE_PERCENTILE = float(os.environ.get('GEMINI_HEDGE_PERCENTILE', 95))
+GEMINI_HEDGE_MIN_DELAY = float(os.environ.get('GEMINI_HEDGE_MIN_DELAY', 1.0))
+GEMINI_HEDGE_DEFAULT_DELAY = float(os.environ.get('GEMINI_HEDGE_DEFAULT_DELAY', 5.0))
+GEMINI_HEDGE_MIN_SAMPLES = 20
+GEMINI_HEDGE_RATE_LIMIT_COOLDOWN = float(os.environ.get('GEMINI_HEDGE_RATE_LIMIT_COOLDOWN', 60))
 
 UPLOAD_FOLDER = 'uploads'
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
+# 既知語彙インデックス設定
+VOCAB_DB_PATH = os.environ.get('VOCAB_DB_PATH', os.path.join(UPLOAD_FOLDER, 'vocabulary.sqlite3'))
+VOCAB_PROMPT_EXCLUDE_LIMIT = int(os.environ.get('VOCAB_PROMPT_EXCLUDE_LIMIT', 200))
+VOCAB_MAX_PHRASE_WORDS = 4
+VOCAB_CACHE_SIZE = int(os.environ.get('VOCAB_CACHE_SIZE', 100))
+
+# PDF・EPUB設定
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
+DOCUMENT_EXTENSIONS = {'pdf', 'epub'} if fitz else {'epub'}
+PDF_TEXT_MIN_CHARS = int(os.environ.get('PDF_TEXT_MIN_CHARS', 40))
+PDF_RASTER_DPI = int(os.environ.get('PDF_RASTER_DPI', 200))
+MAX_DOCUMENT_PAGES = int(os.environ.get('MAX_DOCUMENT_PAGES', 50))
+
+# 重複ページ検出設定（32x32 dHash のハミング距離、1024ビット中）
+# 縦横比が一致し、かつ距離が閾値以下の場合のみOCR結果を再利用する
+PHASH_DEDUP_ENABLED = os.environ.get('PHASH_DEDUP_ENABLED', 'true').lower() == 'true'
+PHASH_HASH_SIZE = 32
+PHASH_THRESHOLD = int(os.environ.get('PHASH_THRESHOLD', 48))
+PHASH_ASPECT_TOLERANCE = float(os.environ.get('PHASH_ASPECT_TOLERANCE', 0.02))
+PHASH_INDEX_SIZE = int(os.environ.get('PHASH_INDEX_SIZE', 500))
+
+# 受付制御設定（/upload の同時処理量と待機キュー）
+ADMISSION_MAX_INFLIGHT_PAGES = int(os.environ.get('ADMISSION_MAX_INFLIGHT_PAGES', 40))
+ADMISSION_MAX_INFLIGHT_TOKENS = int(os.environ.get('ADMISSION_MAX_INFLIGHT_TOKENS', 200000))
+ADMISSION_MAX_QUEUE_PAGES = int(os.environ.get('ADMISSION_MAX_QUEUE_PAGES', 100))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 60))
+ADMISSION_AGING_SECONDS = float(os.environ.get('ADMISSION_AGING_SECONDS', 10))
+ESTIMATED_TOKENS_PER_PAGE = int(os.environ.get('ESTIMATED_TOKENS_PER_PAGE', 2000))
+
+# 分割アップロード設定（セッションはプロセス内に保持）
+UPLOAD_SESSION_TTL = float(os.environ.get('UPLOAD_SESSION_TTL', 3600))
+UPLOAD_SESSION_MAX_FILES = 20
+UPLOAD_SESSION_MAX_ACTIVE = int(os.environ.get('UPLOAD_SESSION_MAX_ACTIVE', 20))
+UPLOAD_SESSION_MAX_BYTES = int(os.environ.get('UPLOAD_SESSION_MAX_BYTES', 200 * 1024 * 1024))
+UPLOAD_OCR_WORKERS = int(os.environ.get('UPLOAD_OCR_WORKERS', 4))
+UPLOAD_STREAM_BLOCK_SIZE = 1024 * 1024
+
+# プロファイリング設定（X-Profile ヘッダーまたは ?profile=1 で /upload を計測）
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', 'false').lower() == 'true'
+PROFILING_TOKEN = os.environ.get('PROFILING_TOKEN')
+PROFILE_FOLDER = os.environ.get('PROFILE_FOLDER', os.path.join(UPLOAD_FOLDER, 'profiles'))
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', 0.005))
+PROFILE_RETENTION = int(os.environ.get('PROFILE_RETENTION', 50))
+
+_vocab_lock = threading.Lock()
+_vocab_cache = OrderedDict()
+
+_phash_lock = threading.Lock()
+_phash_index = OrderedDict()
+
+def file_extension(filename):
+    return filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
+    return file_extension(filename) in IMAGE_EXTENSIONS | DOCUMENT_EXTENSIONS
+
+def is_document_file(filename):
+    return file_extension(filename) in DOCUMENT_EXTENSIONS
+
+def normalize_vocab_word(word):
+    """語彙インデックス用に単語・フレーズを正規化"""
+    return ' '.join(re.findall(r"[a-z]+(?:['’-][a-z]+)*", (word or '').lower()))
+
+def vocabulary_key(user_id=None, book_id=None):
+    """ユーザー単位（または本単位）の語彙インデックスのキーを生成"""
+    # JSONで数値IDが送られる場合もあるため文字列に変換
+    user_id = str(user_id).strip() if user_id is not None else ''
+    book_id = str(book_id).strip() if book_id is not None else ''
+    if not user_id and not book_id:
+        return None
+    return f"{user_id}:{book_id}" if book_id else user_id
+
+def _vocab_connection():
+    conn = sqlite3.connect(VOCAB_DB_PATH, timeout=10)
+    conn.execute("""CREATE TABLE IF NOT EXISTS known_words (
+        owner TEXT NOT NULL,
+        word TEXT NOT NULL,
+        source TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        PRIMARY KEY (owner, word)
+    ) WITHOUT ROWID""")
+    return conn
+
+def load_known_words(owner):
+    """既知語彙を読み取り専用のセットとして取得
+
+    最近使われた VOCAB_CACHE_SIZE 件の所有者分をプロセス内でキャッシュする。
+    """
+    if not owner:
+        return frozenset()
+
+    with _vocab_lock:
+        if owner not in _vocab_cache:
+            conn = _vocab_connection()
+            try:
+                rows = conn.execute("SELECT word FROM known_words WHERE owner = ?", (owner,))
+                _vocab_cache[owner] = frozenset(row[0] for row in rows)
+            finally:
+                conn.close()
+        _vocab_cache.move_to_end(owner)
+        while len(_vocab_cache) > VOCAB_CACHE_SIZE:
+            _vocab_cache.popitem(last=False)
+        return _vocab_cache[owner]
+
+def record_known_words(owner, words, source='returned'):
+    """単語を既知語彙インデックスに登録し、新規登録数を返す"""
+    if not owner:
+        return 0
+
+    normalized = {normalize_vocab_word(w) for w in words}
+    normalized.discard('')
+    if not normalized:
+        return 0
+
+    now = datetime.now().isoformat()
+    with _vocab_lock:
+        conn = _vocab_connection()
+        try:
+            with conn:
+                before = conn.total_changes
+                conn.executemany(
+                    "INSERT OR IGNORE INTO known_words (owner, word, source, created_at) VALUES (?, ?, ?, ?)",
+                    [(owner, w, source, now) for w in normalized]
+                )
+                added = conn.total_changes - before
+        finally:
+            conn.close()
+        # 取得済みのセットは呼び出し側と共有しているため置き換える
+        if owner in _vocab_cache:
+            _vocab_cache[owner] = _vocab_cache[owner] | normalized
+    return added
+
+def find_known_words_in_text(text, known_words):
+    """テキスト中に出現する既知語彙（最大4語のフレーズ）を抽出"""
+    if not known_words:
+        return []
+
+    tokens = normalize_vocab_word(text).split()
+    found = {}
+    for i in range(len(tokens)):
+        for n in range(1, VOCAB_MAX_PHRASE_WORDS + 1):
+            if i + n > len(tokens):
+                break
+            candidate = ' '.join(tokens[i:i + n])
+            if candidate in known_words and candidate not in found:
+                found[candidate] = True
+    return list(found)
+
+def filter_known_words(important_words, known_words):
+    """抽出結果から既知語彙を除外"""
+    if not known_words:
+        return important_words
+    return [w for w in important_words if normalize_vocab_word(w.get("word", "")) not in known_words]
+
+class RequestProfile:
+    """1リクエスト分のプロファイル
+
+    リクエスト処理スレッドのスタックを一定間隔でサンプリングして folded 形式
+    （flamegraph.pl・speedscope で読み込める「関数;関数 回数」形式）で保存し、
+    profile_stage で囲んだ処理ごとの実時間とCPU時間を集計する。
+    """
+
+    def __init__(self, request_id, path):
+        self.request_id = request_id
+        self.path = path
+        self.thread_id = threading.get_ident()
+        self.samples = Counter()
+        self.stages = {}
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+
+    def start(self):
+        self.started_at = datetime.now().isoformat()
+        self.wall_started = time.perf_counter()
+        self.cpu_started = time.thread_time()
+        self._sampler.start()
+
+    def stop(self):
+        self.wall_seconds = time.perf_counter() - self.wall_started
+        self.cpu_seconds = time.thread_time() - self.cpu_started
+        self._stop.set()
+        self._sampler.join()
+
+    def _sample(self):
+        while not self._stop.wait(PROFILE_SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def add_stage(self, name, wall_seconds, cpu_seconds):
+        stage = self.stages.setdefault(name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+        stage['calls'] += 1
+        stage['wall_seconds'] += wall_seconds
+        stage['cpu_seconds'] += cpu_seconds
+
+    def summary(self):
+        return {
+            'request_id': self.request_id,
+            'path': self.path,
+            'started_at': self.started_at,
+            'wall_seconds': round(self.wall_seconds, 4),
+            'cpu_seconds': round(self.cpu_seconds, 4),
+            'sample_interval_seconds': PROFILE_SAMPLE_INTERVAL,
+            'sample_count': sum(self.samples.values()),
+            # ステージは入れ子になり得る（例: upload.extract_text は ocr.* を含む）
+            'stages': {
+                name: {
+                    'calls': stage['calls'],
+                    'wall_seconds': round(stage['wall_seconds'], 4),
+                    'cpu_seconds': round(stage['cpu_seconds'], 4)
+                }
+                for name, stage in sorted(self.stages.items(), key=lambda item: -item[1]['wall_seconds'])
+            },
+            'flamegraph_url': f'/profiles/{self.request_id}/flamegraph'
+        }
+
+    def save(self):
+        os.makedirs(PROFILE_FOLDER, exist_ok=True)
+        with open(os.path.join(PROFILE_FOLDER, f"{self.request_id}.json"), 'w', encoding='utf-8') as f:
+            json.dump(self.summary(), f, ensure_ascii=False, indent=2)
+        with open(os.path.join(PROFILE_FOLDER, f"{self.request_id}.folded"), 'w', encoding='utf-8') as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+        # 古いプロファイルを削除
+        summaries = sorted(
+            (os.path.join(PROFILE_FOLDER, name) for name in os.listdir(PROFILE_FOLDER) if name.endswith('.json')),
+            key=os.path.getmtime
+        )
+        for old in summaries[:-PROFILE_RETENTION]:
+            for path in (old, old[:-len('.json')] + '.folded'):
+                if os.path.exists(path):
+                    os.remove(path)
+
+_active_profile = contextvars.ContextVar('active_profile', default=None)
+
+@contextmanager
+def profile_stage(name):
+    """プロファイリング中のリクエストであれば、囲んだ処理の実時間とCPU時間を記録"""
+    profile = _active_profile.get()
+    if profile is None:
+        yield
+        return
+
+    wall_started = time.perf_counter()
+    cpu_started = time.thread_time()
+    try:
+        yield
+    finally:
+        profile.add_stage(name, time.perf_counter() - wall_started, time.thread_time() - cpu_started)
+
+def profiling_authorized():
+    """プロファイリングが有効で、トークンが設定されている場合は一致するか確認"""
+    if not PROFILING_ENABLED:
+        return False
+    if PROFILING_TOKEN:
+        return hmac.compare_digest(request.headers.get('X-Profile-Token', ''), PROFILING_TOKEN)
+    return True
+
+def profiling_requested():
+    flag = request.headers.get('X-Profile') or request.args.get('profile')
+    return (flag or '').lower() in ('1', 'true', 'yes')
+
+class LatencyHistogram:
+    """対数スケールのバケットでレイテンシ分布を記録する
+
+    件数が上限に達したら全バケットを半減させ、最近の分布に追従させる。
+    """
+    BOUNDS = [0.05 * 1.25 ** i for i in range(40)]  # 50ms〜約300秒
+    DECAY_AT = 2000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total_seconds = 0.0
+
+    def record(self, seconds):
+        index = next((i for i, bound in enumerate(self.BOUNDS) if seconds <= bound), len(self.BOUNDS))
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total_seconds += seconds
+            if self.count >= self.DECAY_AT:
+                self.counts = [c // 2 for c in self.counts]
+                self.total_seconds *= sum(self.counts) / self.count
+                self.count = sum(self.counts)
+
+    def percentile(self, p):
+        with self.lock:
+            if not self.count:
+                return None
+            target = self.count * p / 100
+            cumulative = 0
+            for index, c in enumerate(self.counts):
+                cumulative += c
+                if cumulative >= target:
+                    return self.BOUNDS[min(index, len(self.BOUNDS) - 1)]
+            return self.BOUNDS[-1]
+
+    def snapshot(self):
+        def rounded(p):
+            value = self.percentile(p)
+            return round(value, 3) if value is not None else None
+
+        return {
+            'count': self.count,
+            'mean_seconds': round(self.total_seconds / self.count, 3) if self.count else None,
+            'p50_seconds': rounded(50),
+            'p95_seconds': rounded(95),
+            'p99_seconds': rounded(99)
+        }
+
+_latency_lock = threading.Lock()
+_latency_histograms = {}
+_hedge_stats = {'sent': 0, 'won': 0, 'skipped_rate_limited': 0}
+_rate_limited_until = {}
+_gemini_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('GEMINI_MAX_CONCURRENCY', 16)))
+
+def latency_histogram(model):
+    with _latency_lock:
+        if model not in _latency_histograms:
+            _latency_histograms[model] = LatencyHistogram()
+        return _latency_histograms[model]
+
+def select_gemini_model(task, input_size):
+    """入力サイズに応じて使用するモデルを選択（OCRは画像バイト数、その他はプロンプトに含める文字数）"""
+    limit = ROUTING_LIGHT_MAX_IMAGE_BYTES if task == 'ocr' else ROUTING_LIGHT_MAX_CHARS
+    return GEMINI_MODEL_LIGHT if input_size <= limit else GEMINI_MODEL_STANDARD
+
+def hedge_delay(model):
+    """ヘッジリクエストを送るまでの待機秒数（レイテンシの指定パーセンタイル）"""
+    histogram = latency_histogram(model)
+    if histogram.count < GEMINI_HEDGE_MIN_SAMPLES:
+        return GEMINI_HEDGE_DEFAULT_DELAY
+    return max(GEMINI_HEDGE_MIN_DELAY, histogram.percentile(GEMINI_HEDGE_PERCENTILE))
+
+def rate_limited(model):
+    """直近に 429 を受け取ったモデルかどうか"""
+    with _latency_lock:
+        return time.monotonic() < _rate_limited_until.get(model, 0)
+
+def _post_gemini(api_base, model, payload):
+    url = f"{api_base}/{model}:generateContent?key={GEMINI_API_KEY}"
+    started = time.perf_counter()
+    try:
+        response = requests.post(url, json=payload, headers={"Content-Type": "application/json"}, timeout=GEMINI_REQUEST_TIMEOUT)
+    except Exception:
+        # タイムアウト・接続エラーは記録し、テイルレイテンシを過小評価しない
+        latency_histogram(model).record(time.perf_counter() - started)
+        raise
+    
+    # すぐに返る 429/5xx を含めるとパーセンタイルが下がり、過負荷時にヘッジが増えるため成功のみ記録
+    if response.status_code == 200:
+        latency_histogram(model).record(time.perf_counter() - started)
+    elif response.status_code == 429:
+        with _latency_lock:
+            _rate_limited_until[model] = time.monotonic() + GEMINI_HEDGE_RATE_LIMIT_COOLDOWN
+    return response
+
+def call_gemini_api(payload, task, input_size):
+    """モデルを選択してGemini APIを呼び出す
+
+    ヘッジが有効な場合、一次リクエストがレイテンシのパーセンタイルを超えても
+    応答しなければ二次リクエストを送り、先に成功した応答を返す。
+    直近に 429 を受け取ったモデルではヘッジせず、過負荷のバックエンドに重複リクエストを送らない。
+    """
+    with profile_stage(f'gemini_request.{task}'):
+        return _call_gemini_api(payload, task, input_size)
+
+def _call_gemini_api(payload, task, input_size):
+    model = select_gemini_model(task, input_size)
+    if not GEMINI_HEDGE_ENABLED:
+        return _post_gemini(GEMINI_API_BASE, model, payload)
+
+    primary = _gemini_executor.submit(_post_gemini, GEMINI_API_BASE, model, payload)
+    try:
+        return primary.result(timeout=hedge_delay(model))
+    except FutureTimeoutError:
+        pass
+
+    if rate_limited(model):
+        with _latency_lock:
+            _hedge_stats['skipped_rate_limited'] += 1
+        return primary.result()
+
+    hedge = _gemini_executor.submit(_post_gemini, GEMINI_HEDGE_API_BASE, GEMINI_HEDGE_MODEL or model, payload)
+    with _latency_lock:
+        _hedge_stats['sent'] += 1
+
+    pending = {primary, hedge}
+    fallback, error = None, None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                response = future.result()
+            except Exception as e:
+                error = error or e
+                continue
+            if response.status_code == 200:
+                if future is hedge:
+                    with _latency_lock:
+                        _hedge_stats['won'] += 1
+                return response
+            fallback = fallback or response
+    if fallback is not None:
+        return fallback
+    raise error
+
+def gemini_stats():
+    with _latency_lock:
+        histograms = dict(_latency_histograms)
+        hedges = dict(_hedge_stats)
+    return {
+        'routing': {
+            'standard_model': GEMINI_MODEL_STANDARD,
+            'light_model': GEMINI_MODEL_LIGHT,
+            'light_max_chars': ROUTING_LIGHT_MAX_CHARS,
+            'light_max_image_bytes': ROUTING_LIGHT_MAX_IMAGE_BYTES
+        },
+        'hedging': {
+            'enabled': GEMINI_HEDGE_ENABLED,
+            'model': GEMINI_HEDGE_MODEL,
+            'percentile': GEMINI_HEDGE_PERCENTILE,
+            'rate_limit_cooldown_seconds': GEMINI_HEDGE_RATE_LIMIT_COOLDOWN,
+            **hedges
+        },
+        'latency': {model: h.snapshot() for model, h in histograms.items()}
+    }
 
 def extract_text_with_gemini_api(image_path):
     """Gemini APIを直接使用して画像からテキストを抽出"""
@@ -27,11 +506,10 @@ def extract_text_with_gemini_api(image_path):
     
     try:
         # 画像をbase64にエンコード
-        with open(image_path, 'rb') as image_file:
-            image_data = base64.b64encode(image_file.read()).decode('utf-8')
-        
-        # Gemini API エンドポイント
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent?key={GEMINI_API_KEY}"
+        with profile_stage('ocr.base64_encode'):
+            with open(image_path, 'rb') as image_file:
+                image_bytes = image_file.read()
+            image_data = base64.b64encode(image_bytes).decode('utf-8')
         
         # リクエストペイロード
         payload = {
@@ -48,14 +526,11 @@ def extract_text_with_gemini_api(image_path):
             }]
         }
         
-        headers = {
-            "Content-Type": "application/json"
-        }
-        
-        response = requests.post(url, json=payload, headers=headers)
+        response = call_gemini_api(payload, 'ocr', len(image_bytes))
         
         if response.status_code == 200:
-            result = response.json()
+            with profile_stage('ocr.parse_response'):
+                result = response.json()
             if 'candidates' in result and len(result['candidates']) > 0:
                 text = result['candidates'][0]['content']['parts'][0]['text']
                 return text.strip()
@@ -65,14 +540,262 @@ def extract_text_with_gemini_api(image_path):
     except Exception as e:
         return f"OCRエラー: {str(e)}"
 
+def _dhash(img, hash_size):
+    pixels = list(img.resize((hash_size + 1, hash_size), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+def compute_page_hash(image_path):
+    """画像の差分ハッシュ（32x32 dHash）と縦横比を計算
+
+    9x8 程度の小さなハッシュでは文字ページの内容より照明や余白の影響が大きく、
+    別ページでも近い値になるため、大きめのハッシュを使う。
+    """
+    with Image.open(image_path) as img:
+        aspect = img.width / img.height
+        # JPEGは縮小デコードで読み込みを高速化
+        img.draft('L', ((PHASH_HASH_SIZE + 1) * 8, PHASH_HASH_SIZE * 8))
+        return _dhash(img.convert('L'), PHASH_HASH_SIZE), aspect
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+def dedup_threshold_from(value):
+    """リクエストで指定された閾値をサーバー設定値以下に制限（負の値は重複検出を無効化）"""
+    return min(int(value), PHASH_THRESHOLD) if value is not None else PHASH_THRESHOLD
+
+def find_similar_page(page_hash, aspect, threshold, owner, batch_id):
+    """同じユーザー（または同じバッチ）の最近のページから重複を検索し、(エントリ, 距離) を返す
+
+    _phash_lock を保持した状態で呼ぶ。
+    """
+    best, best_distance = None, threshold + 1
+    for entry in _phash_index.values():
+        # 他のユーザーのOCR結果は再利用しない
+        if entry['batch_id'] != batch_id and (owner is None or entry['owner'] != owner):
+            continue
+        if abs(entry['aspect'] - aspect) > PHASH_ASPECT_TOLERANCE * aspect:
+            continue
+        distance = hamming_distance(page_hash, entry['hash'])
+        if distance < best_distance:
+            best, best_distance = entry, distance
+    return (best, best_distance) if best else (None, None)
+
+def find_or_reserve_page(page_hash, aspect, threshold, filename, owner, batch_id):
+    """重複ページを検索し、見つからなければOCR中のページとして登録する
+
+    並行してOCRされる重複ページが互いを見落とさないよう、検索と登録を同じロック内で行う。
+    戻り値は (エントリ, 距離)。登録した場合の距離は None。
+    """
+    with _phash_lock:
+        entry, distance = find_similar_page(page_hash, aspect, threshold, owner, batch_id)
+        if entry:
+            return entry, distance
+        
+        entry = {
+            'key': (owner or batch_id, page_hash),
+            'hash': page_hash, 'aspect': aspect, 'text': None, 'ready': threading.Event(),
+            'filename': filename, 'owner': owner, 'batch_id': batch_id
+        }
+        _phash_index[entry['key']] = entry
+        _phash_index.move_to_end(entry['key'])
+        while len(_phash_index) > PHASH_INDEX_SIZE:
+            _phash_index.popitem(last=False)
+        return entry, None
+
+def complete_page(entry, text):
+    """OCR中のページに結果を設定（失敗時はインデックスから削除）し、待機中のページに通知"""
+    with _phash_lock:
+        if text is None or is_ocr_error(text):
+            if _phash_index.get(entry['key']) is entry:
+                del _phash_index[entry['key']]
+        else:
+            entry['text'] = text
+    entry['ready'].set()
+
+def extract_text_with_dedup(image_path, filename, batch_id, owner=None, threshold=PHASH_THRESHOLD):
+    """重複ページならOCR結果を再利用し、それ以外はOCRを実行
+
+    再利用するのは同じバッチ内、または同じ語彙インデックスの所有者（owner）のページのみ。
+    類似ページがOCR中の場合はその完了を待って結果を再利用する。
+    戻り値は (テキスト, 重複情報)。重複でない場合の重複情報は None。
+    """
+    if not PHASH_DEDUP_ENABLED or Image is None or threshold < 0:
+        return extract_text_with_gemini_api(image_path), None
+
+    try:
+        page_hash, aspect = compute_page_hash(image_path)
+    except Exception as e:
+        print(f"画像ハッシュ計算エラー: {e}")
+        return extract_text_with_gemini_api(image_path), None
+
+    while True:
+        entry, distance = find_or_reserve_page(page_hash, aspect, threshold, filename, owner, batch_id)
+        if distance is None:
+            break
+        if not entry['ready'].wait(GEMINI_REQUEST_TIMEOUT):
+            # 先行ページのOCRが終わらない場合は待たずに自分でOCRする
+            return extract_text_with_gemini_api(image_path), None
+        if entry['text'] is not None:
+            return entry['text'], {
+                'filename': filename,
+                'duplicate_of': entry['filename'],
+                'distance': distance,
+                'scope': 'batch' if entry['batch_id'] == batch_id else 'recent'
+            }
+        # 先行ページのOCRが失敗した場合は検索からやり直す
+
+    text = None
+    try:
+        text = extract_text_with_gemini_api(image_path)
+    finally:
+        complete_page(entry, text)
+    return text, None
+
+def is_ocr_error(text):
+    """OCR結果がエラーメッセージかどうかを判定"""
+    return not text or text.startswith(("APIエラー", "OCRエラー", "APIキーが設定されていません"))
+
+def parse_page_range(spec, page_count):
+    """"1-10,15" 形式のページ指定を1始まりのページ番号リストに変換"""
+    if not spec or not spec.strip():
+        return list(range(1, page_count + 1))
+
+    pages = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-', 1)
+            start = int(start) if start.strip() else 1
+            end = int(end) if end.strip() else page_count
+        else:
+            start = end = int(part)
+        if start < 1 or end < start:
+            raise ValueError(part)
+        pages.extend(range(start, min(end, page_count) + 1))
+    if not pages:
+        raise ValueError(spec)
+    return sorted(set(pages))
+
+class _HTMLTextExtractor(HTMLParser):
+    """EPUBのXHTMLから本文テキストを抽出"""
+    BLOCK_TAGS = {'p', 'div', 'br', 'li', 'tr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote', 'section'}
+    SKIP_TAGS = {'script', 'style', 'head'}
+
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth += 1
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS and self.skip_depth:
+            self.skip_depth -= 1
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.parts.append(data)
+
+    def text(self):
+        lines = (' '.join(line.split()) for line in ''.join(self.parts).splitlines())
+        return '\n'.join(line for line in lines if line)
+
+def _epub_spine(epub):
+    """EPUBの読み順（spine）に従ったXHTMLファイルのパス一覧を取得"""
+    container = ET.fromstring(epub.read('META-INF/container.xml'))
+    rootfile_node = container.find('.//{*}rootfile')
+    rootfile = rootfile_node.get('full-path') if rootfile_node is not None else None
+    if not rootfile:
+        raise ValueError('container.xml に rootfile がありません')
+    opf = ET.fromstring(epub.read(rootfile))
+    base = posixpath.dirname(rootfile)
+    manifest = {item.get('id'): item.get('href') for item in opf.findall('.//{*}item')}
+    return [
+        posixpath.normpath(posixpath.join(base, manifest[ref.get('idref')]))
+        for ref in opf.findall('.//{*}itemref') if ref.get('idref') in manifest
+    ]
+
+def document_page_count(path):
+    """PDFのページ数またはEPUBの章（spine項目）数を取得（破損・形式不正のファイルは ValueError）"""
+    try:
+        if file_extension(path) == 'pdf':
+            with fitz.open(path) as doc:
+                return doc.page_count
+        with zipfile.ZipFile(path) as epub:
+            return len(_epub_spine(epub))
+    except (zipfile.BadZipFile, KeyError, ET.ParseError, RuntimeError, ValueError):
+        # PyMuPDF の FileDataError などは RuntimeError のサブクラス
+        raise ValueError(f"ファイルを読み込めません: {os.path.basename(path)}")
+
+def iter_document_pages(path, page_numbers=None):
+    """PDF・EPUBを1ページずつ読み出し、(ページ番号, テキスト, 抽出方法) を返す
+
+    テキストレイヤーのあるページはローカルで抽出し、画像のみのPDFページだけを
+    ラスタライズしてOCRに回す。
+    """
+    if file_extension(path) == 'pdf':
+        with fitz.open(path) as doc:
+            for page_number in page_numbers or range(1, doc.page_count + 1):
+                page = doc.load_page(page_number - 1)
+                text = page.get_text('text').strip()
+                if len(text) >= PDF_TEXT_MIN_CHARS:
+                    yield page_number, text, 'text_layer'
+                    continue
+
+                # 入力ディレクトリを汚さないよう一時ファイルにラスタライズ
+                fd, image_path = tempfile.mkstemp(suffix='.jpg')
+                os.close(fd)
+                try:
+                    page.get_pixmap(dpi=PDF_RASTER_DPI).save(image_path)
+                    yield page_number, extract_text_with_gemini_api(image_path), 'ocr'
+                finally:
+                    os.remove(image_path)
+        return
+
+    with zipfile.ZipFile(path) as epub:
+        spine = _epub_spine(epub)
+        for page_number in page_numbers or range(1, len(spine) + 1):
+            parser = _HTMLTextExtractor()
+            parser.feed(epub.read(spine[page_number - 1]).decode('utf-8', errors='replace'))
+            yield page_number, parser.text(), 'text_layer'
+
+def resolve_document_pages(file_path, page_range):
+    """PDF・EPUBの処理対象ページ番号を決定（読み込めないファイル・不正な指定・ページ数超過は ValueError）
+
+    page_range は1リクエスト（または1セッション）内のすべてのPDF・EPUBに共通して適用される。
+    """
+    page_count = document_page_count(file_path)
+    try:
+        page_numbers = parse_page_range(page_range, page_count)
+    except ValueError:
+        raise ValueError(f"不正なページ指定です: {page_range}")
+    if len(page_numbers) > MAX_DOCUMENT_PAGES:
+        raise ValueError(f'1ファイルあたり最大{MAX_DOCUMENT_PAGES}ページまで処理可能です（page_rangeで範囲を指定してください）')
+    return page_numbers
+
+def is_translation_error(text):
+    """翻訳結果がエラーメッセージかどうかを判定"""
+    return not text or text.startswith(("翻訳APIエラー", "翻訳エラー", "APIキーが設定されていません"))
+
 def translate_text_with_gemini_api(text):
     """Gemini APIを使用してテキストを翻訳"""
     if not GEMINI_API_KEY:
         return "APIキーが設定されていません"
     
     try:
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent?key={GEMINI_API_KEY}"
-        
         prompt = f"""以下の英語テキストを自然で読みやすい日本語に翻訳してください。
 文学的な表現や専門用語も適切に翻訳し、原文の意味とニュアンスを保持してください。
 
@@ -85,10 +808,11 @@ def translate_text_with_gemini_api(text):
             }]
         }
         
-        response = requests.post(url, json=payload, headers={"Content-Type": "application/json"})
+        response = call_gemini_api(payload, 'translate', len(text))
         
         if response.status_code == 200:
-            result = response.json()
+            with profile_stage('translate.parse_response'):
+                result = response.json()
             if 'candidates' in result and len(result['candidates']) > 0:
                 translation = result['candidates'][0]['content']['parts'][0]['text']
                 return translation.strip()
@@ -98,13 +822,21 @@ def translate_text_with_gemini_api(text):
     except Exception as e:
         return f"翻訳エラー: {str(e)}"
 
-def extract_words_with_gemini_api(text):
-    """Gemini APIを使用して重要単語・フレーズを抽出"""
+def extract_words_with_gemini_api(text, known_words=None, raise_errors=False):
+    """Gemini APIを使用して重要単語・フレーズを抽出（既知語彙は除外）
+
+    raise_errors=True の場合、APIエラー時に空リストではなく例外を送出する。
+    """
     if not GEMINI_API_KEY:
         return []
     
     try:
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent?key={GEMINI_API_KEY}"
+        # テキスト中に出現する既知語彙のみをプロンプトの除外リストに含める
+        excluded = find_known_words_in_text(text[:1500], known_words)[:VOCAB_PROMPT_EXCLUDE_LIMIT]
+        exclusion_note = f"""
+除外する語句（学習済みのため抽出しないでください）：
+{", ".join(excluded)}
+""" if excluded else ""
         
         prompt = f"""以下の英語テキストから、学習に重要な中級以上の単語・フレーズを抽出し、
 各項目について以下の形式でJSONで返してください（無理に20個まで埋める必要はありません）：
@@ -127,7 +859,7 @@ def extract_words_with_gemini_api(text):
 - 学術的・専門的な語彙を優先
 - 文脈上重要な意味を持つ表現
 - ネイティブがよく使う自然な表現
-
+{exclusion_note}
 英語テキスト:
 {text[:1500]}"""
         
@@ -137,10 +869,11 @@ def extract_words_with_gemini_api(text):
             }]
         }
         
-        response = requests.post(url, json=payload, headers={"Content-Type": "application/json"})
+        response = call_gemini_api(payload, 'words', len(text[:1500]))
         
         if response.status_code == 200:
-            result = response.json()
+            with profile_stage('words.parse_response'):
+                result = response.json()
             if 'candidates' in result and len(result['candidates']) > 0:
                 response_text = result['candidates'][0]['content']['parts'][0]['text']
                 
@@ -152,23 +885,29 @@ def extract_words_with_gemini_api(text):
                 else:
                     json_text = response_text
                 
-                data = json.loads(json_text)
-                return data.get("words", [])
+                with profile_stage('words.parse_json'):
+                    data = json.loads(json_text)
+                return filter_known_words(data.get("words", []), known_words)
         
+        if raise_errors:
+            raise RuntimeError(f"単語抽出APIエラー: {response.status_code}")
         return []
     
     except Exception as e:
+        if raise_errors:
+            raise
         print(f"単語抽出エラー: {e}")
         return []
 
-def extract_grammar_patterns_with_gemini_api(text):
-    """Gemini APIを使用して高度な構文パターンを抽出・解説"""
+def extract_grammar_patterns_with_gemini_api(text, raise_errors=False):
+    """Gemini APIを使用して高度な構文パターンを抽出・解説
+
+    raise_errors=True の場合、APIエラー時に空リストではなく例外を送出する。
+    """
     if not GEMINI_API_KEY:
         return []
     
     try:
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent?key={GEMINI_API_KEY}"
-        
         prompt = f"""以下の英語テキストから、高度で難易度の高い文法・構文パターンのみを抽出し、
 各パターンについて以下の形式でJSONで返してください（簡単な構文は除外してください）：
 
@@ -209,10 +948,11 @@ def extract_grammar_patterns_with_gemini_api(text):
             }]
         }
         
-        response = requests.post(url, json=payload, headers={"Content-Type": "application/json"})
+        response = call_gemini_api(payload, 'grammar', len(text[:1800]))
         
         if response.status_code == 200:
-            result = response.json()
+            with profile_stage('grammar.parse_response'):
+                result = response.json()
             if 'candidates' in result and len(result['candidates']) > 0:
                 response_text = result['candidates'][0]['content']['parts'][0]['text']
                 
@@ -224,12 +964,17 @@ def extract_grammar_patterns_with_gemini_api(text):
                 else:
                     json_text = response_text
                 
-                data = json.loads(json_text)
+                with profile_stage('grammar.parse_json'):
+                    data = json.loads(json_text)
                 return data.get("grammar_patterns", [])
         
+        if raise_errors:
+            raise RuntimeError(f"構文解析APIエラー: {response.status_code}")
         return []
     
     except Exception as e:
+        if raise_errors:
+            raise
         print(f"構文解析エラー: {e}")
         return []
 
@@ -349,10 +1094,10 @@ def index():
         <div class="upload-area" onclick="document.getElementById('file-input').click()">
             <div class="upload-icon">📸</div>
             <div class="upload-text">英語の本の写真をアップロード</div>
-            <div class="upload-subtext">最大20枚まで対応 (PNG, JPG, JPEG, GIF, BMP)</div>
+            <div class="upload-subtext">最大20ファイルまで対応 (PNG, JPG, JPEG, GIF, BMP, PDF, EPUB)</div>
         </div>
         
-        <input type="file" id="file-input" multiple accept="image/*">
+        <input type="file" id="file-input" multiple accept="image/*,application/pdf,application/epub+zip,.epub">
         
         <div id="file-list" class="file-list" style="display: none;"></div>
         
@@ -462,7 +1207,7 @@ def index():
 
         function handleFiles(files) {
             const maxFiles = 20;
-            const allowedTypes = ['image/png', 'image/jpeg', 'image/jpg', 'image/gif', 'image/bmp'];
+            const allowedTypes = ['image/png', 'image/jpeg', 'image/jpg', 'image/gif', 'image/bmp', 'application/pdf', 'application/epub+zip'];
             
             for (let file of files) {
                 if (selectedFiles.length >= maxFiles) {
@@ -470,7 +1215,7 @@ def index():
                     break;
                 }
                 
-                if (!allowedTypes.includes(file.type)) {
+                if (!allowedTypes.includes(file.type) && !file.name.toLowerCase().endsWith('.epub')) {
                     showStatus(`${file.name} は対応していないファイル形式です`, 'error');
                     continue;
                 }
@@ -542,6 +1287,16 @@ def index():
             processBtn.disabled = selectedFiles.length === 0;
         }
 
+        function getUserId() {
+            // 既知語彙インデックス用のユーザーID（ブラウザごとに保持）
+            let userId = localStorage.getItem('vocab_user_id');
+            if (!userId) {
+                userId = Date.now().toString(36) + Math.random().toString(36).slice(2);
+                localStorage.setItem('vocab_user_id', userId);
+            }
+            return userId;
+        }
+
         function formatFileSize(bytes) {
             if (bytes === 0) return '0 Bytes';
             const k = 1024;
@@ -571,6 +1326,7 @@ def index():
                 selectedFiles.forEach(file => {
                     formData.append('files', file);
                 });
+                formData.append('user_id', getUserId());
                 
                 // プログレス更新
                 progressFill.style.width = '20%';
@@ -696,6 +1452,238 @@ def version_check():
         'timestamp': datetime.now().isoformat()
     })
 
+class AdmissionRejected(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"retry after {retry_after}s")
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """処理中のページ数・推定トークン数を制限し、超過分を待機キューに入れる
+
+    待機中のリクエストはページ数の少ないものから順に受け付ける。待機時間に応じて
+    優先度を上げ（aging_seconds ごとに1ページ分）、大きなバッチの飢餓を防ぐ。
+    aging_seconds は最大の重みのリクエストでもタイムアウトの半分で新着の1ページの
+    リクエストより優先されるよう、queue_timeout から決まる値以下に制限する。
+    先頭のリクエストが収まらない間は後続も受け付けないため、処理中の分が終わるにつれて
+    先頭のリクエストの枠が確保される。
+    キューが上限を超える場合やタイムアウトした場合は AdmissionRejected を送出する。
+    """
+
+    def __init__(self, max_pages, max_tokens, max_queue_pages, queue_timeout, aging_seconds):
+        self.max_pages = max_pages
+        self.max_tokens = max_tokens
+        self.max_queue_pages = max_queue_pages
+        self.queue_timeout = queue_timeout
+        self.aging_seconds = min(aging_seconds, queue_timeout / (2 * min(max_pages, max_queue_pages)))
+        self._cond = threading.Condition()
+        self._queue = []
+        self._seq = 0
+        self.inflight_pages = 0
+        self.inflight_tokens = 0
+        self.queued_pages = 0
+        self.admitted_total = 0
+        self.rejected_total = 0
+        # 1ページあたりの処理秒数（指数移動平均）
+        self.seconds_per_page = 5.0
+
+    def _fits(self, ticket):
+        if self.inflight_pages == 0:
+            return True
+        return (self.inflight_pages + ticket['pages'] <= self.max_pages
+                and self.inflight_tokens + ticket['tokens'] <= self.max_tokens)
+
+    def _admit(self, ticket):
+        ticket['admitted'] = True
+        ticket['started_at'] = time.monotonic()
+        self.inflight_pages += ticket['pages']
+        self.inflight_tokens += ticket['tokens']
+        self.admitted_total += 1
+
+    def _dispatch(self):
+        while self._queue:
+            now = time.monotonic()
+            ticket = min(self._queue, key=lambda t: (
+                t['pages'] - (now - t['enqueued_at']) / self.aging_seconds, t['seq']
+            ))
+            if not self._fits(ticket):
+                break
+            self._queue.remove(ticket)
+            self.queued_pages -= ticket['pages']
+            self._admit(ticket)
+        self._cond.notify_all()
+
+    def _retry_after(self, pages=0):
+        backlog = self.inflight_pages + self.queued_pages + pages
+        return max(1, math.ceil(backlog * self.seconds_per_page / self.max_pages))
+
+    def _reject(self, pages):
+        self.rejected_total += 1
+        raise AdmissionRejected(self._retry_after(pages))
+
+    def acquire(self, pages, tokens):
+        with self._cond:
+            self._seq += 1
+            # 同時処理数・キュー容量を超える大きなリクエストは上限の重みで扱う
+            # （キューに入れば単独で実行されるため、再試行しても通らない状態を避ける）
+            ticket = {
+                'pages': min(pages, self.max_pages, self.max_queue_pages),
+                'tokens': min(tokens, self.max_tokens),
+                'actual_pages': pages, 'seq': self._seq,
+                'enqueued_at': time.monotonic(), 'admitted': False
+            }
+            pages = ticket['pages']
+            if not self._queue and self._fits(ticket):
+                self._admit(ticket)
+                return ticket
+            if self.queued_pages + pages > self.max_queue_pages:
+                self._reject(pages)
+            
+            self._queue.append(ticket)
+            self.queued_pages += pages
+            self._dispatch()
+            deadline = ticket['enqueued_at'] + self.queue_timeout
+            while not ticket['admitted']:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._queue.remove(ticket)
+                    self.queued_pages -= pages
+                    self._dispatch()
+                    self._reject(0)
+                self._cond.wait(remaining)
+            return ticket
+
+    def release(self, ticket):
+        with self._cond:
+            elapsed = time.monotonic() - ticket['started_at']
+            self.seconds_per_page = 0.8 * self.seconds_per_page + 0.2 * (elapsed / max(1, ticket['actual_pages']))
+            self.inflight_pages -= ticket['pages']
+            self.inflight_tokens -= ticket['tokens']
+            self._dispatch()
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                'inflight_pages': self.inflight_pages,
+                'inflight_tokens': self.inflight_tokens,
+                'queued_requests': len(self._queue),
+                'queued_pages': self.queued_pages,
+                'max_inflight_pages': self.max_pages,
+                'max_inflight_tokens': self.max_tokens,
+                'max_queue_pages': self.max_queue_pages,
+                'utilization': round(self.inflight_pages / self.max_pages, 3),
+                'accepting': self.queued_pages < self.max_queue_pages,
+                'estimated_wait_seconds': self._retry_after() if self._queue else 0,
+                'seconds_per_page': round(self.seconds_per_page, 2),
+                'aging_seconds': round(self.aging_seconds, 3),
+                'admitted_total': self.admitted_total,
+                'rejected_total': self.rejected_total
+            }
+
+admission_controller = AdmissionController(
+    ADMISSION_MAX_INFLIGHT_PAGES, ADMISSION_MAX_INFLIGHT_TOKENS, ADMISSION_MAX_QUEUE_PAGES,
+    ADMISSION_QUEUE_TIMEOUT, ADMISSION_AGING_SECONDS
+)
+
+def extract_file_text(file_path, page_numbers, batch_id, dedup_threshold, owner=None):
+    """1ファイル分のテキストを抽出し、(テキスト, 抽出方法ごとのページ数, 重複情報) を返す
+
+    page_numbers が指定された場合はPDF・EPUBとして扱い、テキストレイヤーを優先して
+    画像のみのページだけOCRする。
+    """
+    page_stats = {'text_layer': 0, 'ocr': 0, 'duplicate': 0}
+    
+    if page_numbers is not None:
+        text = ""
+        for _, page_text, method in iter_document_pages(file_path, page_numbers):
+            if page_text and not is_ocr_error(page_text):
+                text += page_text + "\n\n"
+                page_stats[method] += 1
+        return text, page_stats, None
+    
+    extracted_text, duplicate = extract_text_with_dedup(
+        file_path, os.path.basename(file_path), batch_id, owner, dedup_threshold
+    )
+    if duplicate:
+        page_stats['duplicate'] += 1
+        # 同じバッチ内の重複ページは本文に重ねて追加しない
+        if duplicate['scope'] == 'batch':
+            return "", page_stats, duplicate
+    if is_ocr_error(extracted_text):
+        return "", page_stats, duplicate
+    if not duplicate:
+        page_stats['ocr'] += 1
+    return extracted_text + "\n\n", page_stats, duplicate
+
+def merge_extracted_texts(results):
+    """ファイルごとの抽出結果を (全テキスト, 抽出方法ごとのページ数, 重複ページ一覧) にまとめる"""
+    all_text = ""
+    page_stats = {'text_layer': 0, 'ocr': 0, 'duplicate': 0}
+    duplicate_pages = []
+    
+    for text, file_stats, duplicate in results:
+        all_text += text
+        for method, count in file_stats.items():
+            page_stats[method] += count
+        if duplicate:
+            duplicate_pages.append(duplicate)
+    
+    return all_text, page_stats, duplicate_pages
+
+def extract_uploaded_texts(uploaded_files, document_pages, dedup_threshold, owner=None):
+    """アップロードファイルから順にテキストを抽出"""
+    batch_id = uuid.uuid4().hex
+    return merge_extracted_texts(
+        extract_file_text(file_path, document_pages.get(file_path), batch_id, dedup_threshold, owner)
+        for file_path in uploaded_files
+    )
+
+def build_report(all_text, vocab_owner, temp_dir):
+    """翻訳・語句・構文解析を行い、レポートを含むレスポンスを作成"""
+    # 翻訳
+    translated_text = translate_text_with_gemini_api(all_text)
+    
+    # 重要単語・フレーズ抽出（既知語彙を除外し、返した語句を記録）
+    known_words = load_known_words(vocab_owner)
+    important_words = extract_words_with_gemini_api(all_text, known_words)
+    record_known_words(vocab_owner, [w.get("word", "") for w in important_words])
+    
+    # 構文パターン抽出
+    grammar_patterns = extract_grammar_patterns_with_gemini_api(all_text)
+    
+    # テキストドキュメント作成
+    with profile_stage('report.create_text_document'):
+        doc_content = create_text_document(all_text, translated_text, important_words, grammar_patterns)
+    
+    # ファイル保存
+    output_filename = f"translation_analysis_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+    output_path = os.path.join(temp_dir, output_filename)
+    
+    with open(output_path, 'w', encoding='utf-8') as f:
+        f.write(doc_content)
+    
+    # ファイルをバイナリで読み込み
+    with open(output_path, 'rb') as f:
+        file_data = f.read()
+    
+    return {
+        'status': 'success',
+        'original_text': all_text[:500] + '...' if len(all_text) > 500 else all_text,
+        'translated_text': translated_text[:500] + '...' if len(translated_text) > 500 else translated_text,
+        'word_count': len(important_words),
+        'grammar_count': len(grammar_patterns),
+        'download_url': f'/download/{output_filename}',
+        'file_data': base64.b64encode(file_data).decode('utf-8'),
+        'filename': output_filename
+    }
+
+def overloaded_response(retry_after):
+    response = jsonify({
+        'error': 'サーバーが混雑しています。しばらくしてから再試行してください',
+        'retry_after': retry_after
+    })
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 503
+
 @app.route('/upload', methods=['POST'])
 def upload_files():
     if 'files' not in request.files:
@@ -712,73 +1700,488 @@ def upload_files():
     
     try:
         # ファイルをアップロード
-        for file in files:
-            if file and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                filepath = os.path.join(temp_dir, filename)
-                file.save(filepath)
-                uploaded_files.append(filepath)
+        with profile_stage('upload.save_files'):
+            for file in files:
+                if file and allowed_file(file.filename):
+                    filename = secure_filename(file.filename)
+                    filepath = os.path.join(temp_dir, filename)
+                    file.save(filepath)
+                    uploaded_files.append(filepath)
         
         if not uploaded_files:
-            return jsonify({'error': '有効な画像ファイルがありません'}), 400
-        
-        # OCR処理
-        all_text = ""
-        
-        for image_path in uploaded_files:
-            extracted_text = extract_text_with_gemini_api(image_path)
-            if extracted_text and not extracted_text.startswith("APIエラー") and not extracted_text.startswith("OCRエラー"):
-                all_text += extracted_text + "\n\n"
-        
-        if not all_text.strip():
-            return jsonify({'error': 'テキストを抽出できませんでした'}), 400
-        
-        # 翻訳
-        translated_text = translate_text_with_gemini_api(all_text)
-        
-        # 重要単語・フレーズ抽出
-        important_words = extract_words_with_gemini_api(all_text)
-        
-        # 構文パターン抽出
-        grammar_patterns = extract_grammar_patterns_with_gemini_api(all_text)
+            shutil.rmtree(temp_dir)
+            return jsonify({'error': '有効なファイルがありません'}), 400
         
-        # テキストドキュメント作成
-        doc_content = create_text_document(all_text, translated_text, important_words, grammar_patterns)
+        try:
+            dedup_threshold = dedup_threshold_from(request.form.get('dedup_threshold'))
+        except ValueError:
+            shutil.rmtree(temp_dir)
+            return jsonify({'error': 'dedup_threshold は整数で指定してください'}), 400
         
-        # ファイル保存
-        output_filename = f"translation_analysis_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-        output_path = os.path.join(temp_dir, output_filename)
+        # PDF・EPUBの処理対象ページを決定（page_range は全ドキュメントに共通）
+        document_pages = {}
+        for file_path in uploaded_files:
+            if not is_document_file(file_path):
+                continue
+            try:
+                document_pages[file_path] = resolve_document_pages(file_path, request.form.get('page_range'))
+            except ValueError as e:
+                shutil.rmtree(temp_dir)
+                return jsonify({'error': str(e)}), 400
         
-        with open(output_path, 'w', encoding='utf-8') as f:
-            f.write(doc_content)
+        # 受付制御（処理中・待機中のページ数と推定トークン数で判断）
+        page_count = len(uploaded_files) - len(document_pages) + sum(len(p) for p in document_pages.values())
+        try:
+            with profile_stage('upload.admission_wait'):
+                ticket = admission_controller.acquire(page_count, page_count * ESTIMATED_TOKENS_PER_PAGE)
+        except AdmissionRejected as e:
+            shutil.rmtree(temp_dir)
+            return overloaded_response(e.retry_after)
         
-        # ファイルをバイナリで読み込み
-        with open(output_path, 'rb') as f:
-            file_data = f.read()
+        try:
+            vocab_owner = vocabulary_key(request.form.get('user_id'), request.form.get('book_id'))
+            with profile_stage('upload.extract_text'):
+                all_text, page_stats, duplicate_pages = extract_uploaded_texts(
+                    uploaded_files, document_pages, dedup_threshold, vocab_owner
+                )
+            
+            if not all_text.strip():
+                shutil.rmtree(temp_dir)
+                return jsonify({'error': 'テキストを抽出できませんでした'}), 400
+            
+            with profile_stage('upload.build_report'):
+                result = build_report(all_text, vocab_owner, temp_dir)
+        finally:
+            admission_controller.release(ticket)
         
         # 一時ファイル削除
-        import shutil
         shutil.rmtree(temp_dir)
         
         # レスポンス
-        return jsonify({
-            'status': 'success',
-            'original_text': all_text[:500] + '...' if len(all_text) > 500 else all_text,
-            'translated_text': translated_text[:500] + '...' if len(translated_text) > 500 else translated_text,
-            'word_count': len(important_words),
-            'grammar_count': len(grammar_patterns),
-            'download_url': f'/download/{output_filename}',
-            'file_data': base64.b64encode(file_data).decode('utf-8'),
-            'filename': output_filename
-        })
+        result['page_stats'] = page_stats
+        result['duplicate_pages'] = duplicate_pages
+        return jsonify(result)
     
     except Exception as e:
         # エラー時は一時ディレクトリを削除
-        import shutil
         if os.path.exists(temp_dir):
             shutil.rmtree(temp_dir)
         return jsonify({'error': f'処理中にエラーが発生しました: {str(e)}'}), 500
 
+class UploadLimitExceeded(Exception):
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+class UploadSession:
+    """再開可能な分割アップロードのセッション
+
+    各ファイルは受信が完了した時点でOCRに投入され、finalize で結果をまとめる。
+    """
+
+    def __init__(self, options):
+        self.id = uuid.uuid4().hex
+        self.batch_id = uuid.uuid4().hex
+        self.temp_dir = tempfile.mkdtemp()
+        self.options = options
+        self.lock = threading.Lock()
+        self.files = OrderedDict()
+        self.finalizing = False
+        self.touched_at = time.monotonic()
+
+    def expired(self):
+        return time.monotonic() - self.touched_at > UPLOAD_SESSION_TTL
+
+    def file_state(self, filename, length):
+        """ファイルの受信状態を取得（未登録なら作成、上限超過は UploadLimitExceeded）"""
+        with self.lock:
+            if filename not in self.files:
+                if len(self.files) >= UPLOAD_SESSION_MAX_FILES:
+                    raise UploadLimitExceeded(f'最大{UPLOAD_SESSION_MAX_FILES}ファイルまで処理可能です', 400)
+                # 宣言サイズの合計で制限する（受信データは Upload-Length を超えない）
+                if sum(s['length'] for s in self.files.values()) + length > UPLOAD_SESSION_MAX_BYTES:
+                    raise UploadLimitExceeded(
+                        f'1セッションあたり合計{UPLOAD_SESSION_MAX_BYTES // (1024 * 1024)}MBまで処理可能です', 413
+                    )
+                self.files[filename] = {
+                    'path': os.path.join(self.temp_dir, filename),
+                    'length': length,
+                    'received': 0,
+                    'sha256': hashlib.sha256(),
+                    'expected_sha256': None,
+                    'pages': None,
+                    'future': None,
+                    'error': None,
+                    'lock': threading.Lock()
+                }
+            return self.files[filename]
+
+    def status(self):
+        with self.lock:
+            files = [
+                {
+                    'filename': filename,
+                    'length': state['length'],
+                    'received': state['received'],
+                    'complete': state['received'] == state['length'],
+                    'ocr_status': (
+                        'error' if state['error'] else
+                        'pending' if state['future'] is None else
+                        'done' if state['future'].done() else 'processing'
+                    ),
+                    'error': state['error']
+                }
+                for filename, state in self.files.items()
+            ]
+        return {'session_id': self.id, 'finalizing': self.finalizing, 'files': files}
+
+    def cleanup(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+_upload_sessions_lock = threading.Lock()
+_upload_sessions = {}
+_ocr_executor = ThreadPoolExecutor(max_workers=UPLOAD_OCR_WORKERS)
+
+def sweep_expired_upload_sessions():
+    """期限切れのセッションを削除（_upload_sessions_lock を保持した状態で呼ぶ）"""
+    for expired in [s for s in _upload_sessions.values() if s.expired()]:
+        del _upload_sessions[expired.id]
+        expired.cleanup()
+
+def get_upload_session(session_id):
+    with _upload_sessions_lock:
+        sweep_expired_upload_sessions()
+        session = _upload_sessions.get(session_id)
+        if session:
+            session.touched_at = time.monotonic()
+        return session
+
+def discard_upload_session(session):
+    with _upload_sessions_lock:
+        _upload_sessions.pop(session.id, None)
+    session.cleanup()
+
+def run_session_ocr(session, state, ticket):
+    try:
+        return extract_file_text(
+            state['path'], state['pages'], session.batch_id, session.options['dedup_threshold'],
+            vocabulary_key(session.options['user_id'], session.options['book_id'])
+        )
+    finally:
+        admission_controller.release(ticket)
+
+def write_upload_chunk(state, offset):
+    """リクエスト本文を offset 位置から書き込み、書き込みバイト数を返す
+
+    途中で接続が切れた場合やエラー時は offset まで切り詰め、同じオフセットから再送できるようにする。
+    """
+    chunk_hash = hashlib.sha256()
+    file_hash = state['sha256'].copy()
+    written = 0
+    
+    with open(state['path'], 'ab'):
+        pass
+    with open(state['path'], 'r+b') as f:
+        # 前回の中断で残った未確定のデータを破棄
+        f.seek(offset)
+        f.truncate(offset)
+        try:
+            while True:
+                block = request.stream.read(UPLOAD_STREAM_BLOCK_SIZE)
+                if not block:
+                    break
+                if f.tell() + len(block) > state['length']:
+                    raise ValueError('Upload-Length を超えるデータが送信されました')
+                f.write(block)
+                chunk_hash.update(block)
+                file_hash.update(block)
+                written += len(block)
+            
+            expected = request.headers.get('X-Chunk-Sha256')
+            if expected and expected.lower() != chunk_hash.hexdigest():
+                raise ValueError('チャンクのチェックサムが一致しません')
+        except BaseException:
+            f.truncate(offset)
+            raise
+    
+    state['sha256'] = file_hash
+    state['received'] += written
+    return written
+
+def submit_session_file(session, state):
+    """受信完了したファイルを検証し、OCRに投入"""
+    expected = state['expected_sha256']
+    if expected and expected.lower() != state['sha256'].hexdigest():
+        # 破損したファイルは破棄して最初から再送してもらう
+        os.remove(state['path'])
+        state['received'] = 0
+        state['sha256'] = hashlib.sha256()
+        state['expected_sha256'] = None
+        raise ValueError('ファイルのチェックサムが一致しません（最初から再送してください）')
+    
+    page_count = 1
+    if is_document_file(state['path']):
+        try:
+            state['pages'] = resolve_document_pages(state['path'], session.options['page_range'])
+        except Exception as e:
+            # 失敗を記録し、finalize で未受信扱いにならないようにする
+            state['error'] = str(e) if isinstance(e, ValueError) else f'ファイルを読み込めません: {e}'
+            raise ValueError(state['error'])
+        page_count = len(state['pages'])
+    
+    ticket = admission_controller.acquire(page_count, page_count * ESTIMATED_TOKENS_PER_PAGE)
+    state['future'] = _ocr_executor.submit(run_session_ocr, session, state, ticket)
+
+@app.route('/upload/sessions', methods=['POST'])
+def create_upload_session():
+    data = request.get_json(silent=True) or request.form
+    try:
+        dedup_threshold = dedup_threshold_from(data.get('dedup_threshold'))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'dedup_threshold は整数で指定してください'}), 400
+    
+    # 期限切れのセッションを削除し、同時に保持するセッション数を制限
+    with _upload_sessions_lock:
+        sweep_expired_upload_sessions()
+        if len(_upload_sessions) >= UPLOAD_SESSION_MAX_ACTIVE:
+            now = time.monotonic()
+            retry_after = max(1, math.ceil(min(
+                UPLOAD_SESSION_TTL - (now - s.touched_at) for s in _upload_sessions.values()
+            )))
+            return overloaded_response(retry_after)
+        session = UploadSession({
+            'user_id': data.get('user_id'),
+            'book_id': data.get('book_id'),
+            'page_range': data.get('page_range'),
+            'dedup_threshold': dedup_threshold
+        })
+        _upload_sessions[session.id] = session
+    
+    return jsonify({
+        'session_id': session.id,
+        'upload_url': f'/upload/sessions/{session.id}/files/<filename>',
+        'finalize_url': f'/upload/sessions/{session.id}/finalize',
+        'expires_in': UPLOAD_SESSION_TTL
+    }), 201
+
+@app.route('/upload/sessions/<session_id>', methods=['GET'])
+def upload_session_status(session_id):
+    session = get_upload_session(session_id)
+    if not session:
+        return jsonify({'error': 'セッションが見つかりません'}), 404
+    return jsonify(session.status())
+
+@app.route('/upload/sessions/<session_id>', methods=['DELETE'])
+def delete_upload_session(session_id):
+    session = get_upload_session(session_id)
+    if not session:
+        return jsonify({'error': 'セッションが見つかりません'}), 404
+    discard_upload_session(session)
+    return jsonify({'status': 'deleted'})
+
+@app.route('/upload/sessions/<session_id>/files/<filename>', methods=['PUT'])
+def upload_session_chunk(session_id, filename):
+    """ファイル（またはその一部）を受信
+
+    Upload-Offset に書き込み開始位置、Upload-Length にファイル全体のサイズを指定する。
+    X-Chunk-Sha256 / X-File-Sha256 を指定するとチャンク・ファイル全体を検証する。
+    オフセットが受信済みサイズと異なる場合は 409 と現在のオフセットを返す。
+    """
+    session = get_upload_session(session_id)
+    if not session:
+        return jsonify({'error': 'セッションが見つかりません'}), 404
+    
+    filename = secure_filename(filename)
+    if not allowed_file(filename):
+        return jsonify({'error': f'{filename} は対応していないファイル形式です'}), 400
+    
+    try:
+        offset = int(request.headers.get('Upload-Offset', 0))
+        length = int(request.headers['Upload-Length'])
+    except (KeyError, ValueError):
+        return jsonify({'error': 'Upload-Offset と Upload-Length を整数で指定してください'}), 400
+    if length <= 0 or length > app.config['MAX_CONTENT_LENGTH']:
+        return jsonify({'error': 'ファイルサイズが不正です'}), 400
+    
+    if session.finalizing:
+        return jsonify({'error': 'セッションは確定処理中です'}), 409
+    
+    try:
+        state = session.file_state(filename, length)
+    except UploadLimitExceeded as e:
+        return jsonify({'error': str(e)}), e.status
+    
+    with state['lock']:
+        if state['length'] != length:
+            return jsonify({'error': 'Upload-Length が以前の指定と一致しません'}), 409
+        if offset != state['received']:
+            return jsonify({'error': 'オフセットが一致しません', 'offset': state['received']}), 409
+        if state['error']:
+            return jsonify({'error': state['error'], 'offset': state['received']}), 400
+        if request.headers.get('X-File-Sha256'):
+            state['expected_sha256'] = request.headers['X-File-Sha256']
+        
+        try:
+            if state['received'] < state['length']:
+                write_upload_chunk(state, offset)
+            
+            # 受信が完了したらすぐにOCRへ投入（未投入の場合のみ）
+            if state['received'] == state['length'] and state['future'] is None and not state['error']:
+                submit_session_file(session, state)
+        except AdmissionRejected as e:
+            # ファイルは受信済みのため、同じオフセットで再送すれば投入を再試行できる
+            return overloaded_response(e.retry_after)
+        except ValueError as e:
+            return jsonify({'error': str(e), 'offset': state['received']}), 400
+        
+        return jsonify({
+            'filename': filename,
+            'offset': state['received'],
+            'length': state['length'],
+            'complete': state['received'] == state['length']
+        })
+
+@app.route('/upload/sessions/<session_id>/finalize', methods=['POST'])
+def finalize_upload_session(session_id):
+    session = get_upload_session(session_id)
+    if not session:
+        return jsonify({'error': 'セッションが見つかりません'}), 404
+    
+    with session.lock:
+        if session.finalizing:
+            return jsonify({'error': 'セッションは確定処理中です'}), 409
+        states = list(session.files.values())
+        errors = [s['error'] for s in states if s['error']]
+        incomplete = [name for name, s in session.files.items() if s['future'] is None and not s['error']]
+        if not states:
+            return jsonify({'error': 'ファイルが選択されていません'}), 400
+        if errors:
+            return jsonify({'error': errors[0]}), 400
+        if incomplete:
+            return jsonify({'error': '受信が完了していないファイルがあります', 'incomplete_files': incomplete}), 409
+        session.finalizing = True
+    
+    try:
+        # 受信中に開始したOCRの完了を待ってまとめる
+        all_text, page_stats, duplicate_pages = merge_extracted_texts(s['future'].result() for s in states)
+        
+        if not all_text.strip():
+            discard_upload_session(session)
+            return jsonify({'error': 'テキストを抽出できませんでした'}), 400
+        
+        page_count = sum(len(s['pages']) if s['pages'] else 1 for s in states)
+        try:
+            ticket = admission_controller.acquire(page_count, page_count * ESTIMATED_TOKENS_PER_PAGE)
+        except AdmissionRejected as e:
+            session.finalizing = False
+            return overloaded_response(e.retry_after)
+        
+        try:
+            vocab_owner = vocabulary_key(session.options['user_id'], session.options['book_id'])
+            result = build_report(all_text, vocab_owner, session.temp_dir)
+        finally:
+            admission_controller.release(ticket)
+        
+        discard_upload_session(session)
+        
+        result['session_id'] = session.id
+        result['page_stats'] = page_stats
+        result['duplicate_pages'] = duplicate_pages
+        return jsonify(result)
+    
+    except Exception as e:
+        discard_upload_session(session)
+        return jsonify({'error': f'処理中にエラーが発生しました: {str(e)}'}), 500
+
+@app.before_request
+def start_profiling():
+    if request.endpoint != 'upload_files' or not profiling_requested() or not profiling_authorized():
+        return
+    
+    profile = RequestProfile(uuid.uuid4().hex, request.path)
+    g.profile_token = _active_profile.set(profile)
+    profile.start()
+
+@app.after_request
+def finish_profiling(response):
+    profile = _active_profile.get()
+    if profile is None:
+        return response
+    
+    profile.stop()
+    _active_profile.reset(g.pop('profile_token'))
+    try:
+        profile.save()
+    except OSError as e:
+        print(f"プロファイル保存エラー: {e}")
+        return response
+    
+    response.headers['X-Profile-Id'] = profile.request_id
+    response.headers['X-Profile-Url'] = f'/profiles/{profile.request_id}'
+    return response
+
+@app.teardown_request
+def discard_unfinished_profile(error=None):
+    # 例外などで after_request が実行されなかった場合もサンプリングを止める
+    if 'profile_token' in g:
+        _active_profile.get().stop()
+        _active_profile.reset(g.pop('profile_token'))
+
+def load_profile_file(request_id, extension):
+    if not profiling_authorized():
+        return None
+    if not re.fullmatch(r'[0-9a-f]{32}', request_id):
+        return None
+    path = os.path.join(PROFILE_FOLDER, f"{request_id}.{extension}")
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+@app.route('/profiles/<request_id>', methods=['GET'])
+def get_profile(request_id):
+    content = load_profile_file(request_id, 'json')
+    if content is None:
+        return jsonify({'error': 'プロファイルが見つかりません'}), 404
+    return app.response_class(content, mimetype='application/json')
+
+@app.route('/profiles/<request_id>/flamegraph', methods=['GET'])
+def get_profile_flamegraph(request_id):
+    content = load_profile_file(request_id, 'folded')
+    if content is None:
+        return jsonify({'error': 'プロファイルが見つかりません'}), 404
+    return app.response_class(content, mimetype='text/plain')
+
+@app.route('/vocabulary', methods=['GET'])
+def vocabulary_status():
+    owner = vocabulary_key(request.args.get('user_id'), request.args.get('book_id'))
+    if not owner:
+        return jsonify({'error': 'user_id または book_id を指定してください'}), 400
+    
+    return jsonify({
+        'owner': owner,
+        'known_word_count': len(load_known_words(owner))
+    })
+
+@app.route('/vocabulary/known', methods=['POST'])
+def mark_known_words():
+    data = request.get_json(silent=True) or {}
+    owner = vocabulary_key(data.get('user_id'), data.get('book_id'))
+    if not owner:
+        return jsonify({'error': 'user_id または book_id を指定してください'}), 400
+    
+    words = data.get('words')
+    if not isinstance(words, list) or not words:
+        return jsonify({'error': '単語リストが空です'}), 400
+    
+    added = record_known_words(owner, [str(w) for w in words], source='marked')
+    return jsonify({
+        'status': 'success',
+        'owner': owner,
+        'added': added,
+        'known_word_count': len(load_known_words(owner))
+    })
+
 @app.route('/health')
 def health_check():
     api_key_status = 'ok' if GEMINI_API_KEY else 'missing'
@@ -786,6 +2189,7 @@ def health_check():
         'status': 'healthy', 
         'version': 'latest-production-v2',
         'api_key_status': api_key_status,
+        'load': admission_controller.snapshot(),
         'message': 'アプリは正常に動作しています！',
         'timestamp': datetime.now().isoformat()
     })
@@ -799,6 +2203,7 @@ def debug_info():
         'current_directory': os.getcwd(),
         'template_folder': app.template_folder,
         'gemini_api_configured': bool(GEMINI_API_KEY),
+        'gemini': gemini_stats(),
         'environment_vars': {
             'PORT': os.environ.get('PORT', 'Not Set'),
             'PYTHON_VERSION': os.environ.get('PYTHON_VERSION', 'Not Set')
@@ -0,0 +1,321 @@
+"""書籍一括処理用のコマンドラインツール
+
+ページ画像（またはPDF・EPUB）のディレクトリを OCR・翻訳・解析し、章ごとのレポートと書籍全体のレポートを出力する。
+処理済みページ・章はチェックポイントファイルに記録され、中断後の再実行では未処理分のみを処理する。
+
+使い方:
+    python batch.py <ページ画像ディレクトリ> -o <出力ディレクトリ> [--workers 4] [--pages-per-chapter 20]
+
+入力ディレクトリにサブディレクトリがある場合は、サブディレクトリごとに1章として扱う。
+PDF・EPUBはページ（EPUBはspine項目）単位に展開して処理する。
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+from app import (
+    GEMINI_API_KEY,
+    allowed_file,
+    create_text_document,
+    document_page_count,
+    extract_grammar_patterns_with_gemini_api,
+    extract_text_with_gemini_api,
+    extract_words_with_gemini_api,
+    is_document_file,
+    is_ocr_error,
+    is_translation_error,
+    iter_document_pages,
+    load_known_words,
+    normalize_vocab_word,
+    record_known_words,
+    translate_text_with_gemini_api,
+    vocabulary_key,
+)
+
+CHECKPOINT_FILENAME = 'checkpoint.json'
+
+def natural_sort_key(name):
+    """ファイル名中の数字を数値として比較するソートキー（page2 < page10）"""
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', name)]
+
+def list_page_files(directory):
+    return sorted(
+        (f for f in os.listdir(directory)
+         if os.path.isfile(os.path.join(directory, f)) and allowed_file(f)),
+        key=natural_sort_key
+    )
+
+def expand_pages(input_dir, rel_path):
+    """PDF・EPUBを「ファイル#ページ番号」形式のページ単位に展開"""
+    if not is_document_file(rel_path):
+        return [rel_path]
+    try:
+        page_count = document_page_count(os.path.join(input_dir, rel_path))
+    except ValueError as e:
+        # 読み込めないファイルは1ページとして扱い、OCR処理で失敗として数える
+        print(f"⚠️  {e}", file=sys.stderr)
+        return [f"{rel_path}#1"]
+    return [f"{rel_path}#{n}" for n in range(1, page_count + 1)]
+
+def collect_chapters(input_dir, pages_per_chapter):
+    """入力ディレクトリから章ごとのページ一覧（入力ディレクトリからの相対パス）を作成"""
+    chapters = []
+
+    subdirs = sorted(
+        (d for d in os.listdir(input_dir) if os.path.isdir(os.path.join(input_dir, d))),
+        key=natural_sort_key
+    )
+    for subdir in subdirs:
+        pages = [
+            page for f in list_page_files(os.path.join(input_dir, subdir))
+            for page in expand_pages(input_dir, os.path.join(subdir, f))
+        ]
+        if pages:
+            chapters.append((subdir, pages))
+
+    # 直下のページ画像は指定ページ数ごとに章へ分割
+    top_level = [page for f in list_page_files(input_dir) for page in expand_pages(input_dir, f)]
+    for start in range(0, len(top_level), pages_per_chapter):
+        chunk = top_level[start:start + pages_per_chapter]
+        chapters.append((f"pages_{start + 1:04d}-{start + len(chunk):04d}", chunk))
+
+    return chapters
+
+class Checkpoint:
+    """処理済みページ・章の結果を保持し、更新のたびにファイルへ書き出す"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = {'pages': {}, 'chapters': {}}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.data.update(json.load(f))
+
+    def page_text(self, page):
+        return self.data['pages'].get(page)
+
+    def chapter_result(self, chapter):
+        return self.data['chapters'].get(chapter)
+
+    def set_page(self, page, text):
+        with self.lock:
+            self.data['pages'][page] = text
+            self._save()
+
+    def set_chapter(self, chapter, result):
+        with self.lock:
+            self.data['chapters'][chapter] = result
+            self._save()
+
+    def _save(self):
+        # 書き込み途中で中断されても壊れないよう一時ファイル経由で置き換える
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.data, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+def ocr_page(input_dir, page):
+    path, _, page_number = page.partition('#')
+    if page_number:
+        _, text, _ = next(iter_document_pages(os.path.join(input_dir, path), [int(page_number)]))
+        return page, text
+    return page, extract_text_with_gemini_api(os.path.join(input_dir, page))
+
+def analyze_chapter(chapter_text, vocab_owner):
+    """章のテキストを翻訳し、重要語句と構文パターンを抽出
+
+    いずれかのAPI呼び出しが失敗した場合は例外を送出し、章をチェックポイントに記録しない。
+    """
+    known_words = load_known_words(vocab_owner)
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        translation_future = executor.submit(translate_text_with_gemini_api, chapter_text)
+        words_future = executor.submit(extract_words_with_gemini_api, chapter_text, known_words, raise_errors=True)
+        grammar_future = executor.submit(extract_grammar_patterns_with_gemini_api, chapter_text, raise_errors=True)
+        translated_text = translation_future.result()
+        if is_translation_error(translated_text):
+            raise RuntimeError(translated_text)
+        important_words = words_future.result()
+        grammar_patterns = grammar_future.result()
+
+    return {
+        'translated_text': translated_text,
+        'important_words': important_words,
+        'grammar_patterns': grammar_patterns
+    }
+
+def write_report(path, content):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(content)
+
+def merge_words(chapter_results):
+    """章ごとの重要語句を重複なく結合"""
+    merged = []
+    seen = set()
+    for result in chapter_results:
+        for word_info in result['important_words']:
+            key = normalize_vocab_word(word_info.get("word", ""))
+            if key and key not in seen:
+                seen.add(key)
+                merged.append(word_info)
+    return merged
+
+def run_batch(input_dir, output_dir, workers, pages_per_chapter, vocab_owner=None):
+    os.makedirs(os.path.join(output_dir, 'chapters'), exist_ok=True)
+    checkpoint = Checkpoint(os.path.join(output_dir, CHECKPOINT_FILENAME))
+    chapters = collect_chapters(input_dir, pages_per_chapter)
+    all_pages = [page for _, pages in chapters for page in pages]
+
+    stats = {
+        'pages_total': len(all_pages),
+        'pages_resumed': 0,
+        'pages_processed': 0,
+        'pages_failed': 0,
+        'chapters_total': len(chapters),
+        'chapters_resumed': 0,
+        'chapters_processed': 0,
+        'chapters_failed': 0,
+        'ocr_seconds': 0.0,
+        'analysis_seconds': 0.0
+    }
+    started = time.perf_counter()
+
+    # OCR処理（未処理ページのみ並列実行）
+    pending_pages = [p for p in all_pages if checkpoint.page_text(p) is None]
+    stats['pages_resumed'] = len(all_pages) - len(pending_pages)
+    print(f"OCR: {len(pending_pages)}ページを処理します（再開済み: {stats['pages_resumed']}ページ）")
+
+    ocr_started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(ocr_page, input_dir, page): page for page in pending_pages}
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                page, text = future.result()
+            except Exception as e:
+                # 破損したPDF・EPUBなどは失敗として数え、残りのページの処理を続ける
+                stats['pages_failed'] += 1
+                print(f"  [{done}/{len(pending_pages)}] {futures[future]}: 失敗 ({e})")
+                continue
+            # 空のページ（表紙・白紙など）は空文字のまま完了扱いにする
+            if text != '' and is_ocr_error(text):
+                stats['pages_failed'] += 1
+                print(f"  [{done}/{len(pending_pages)}] {page}: 失敗 ({text})")
+                continue
+            checkpoint.set_page(page, text)
+            stats['pages_processed'] += 1
+            print(f"  [{done}/{len(pending_pages)}] {page}: 完了")
+    stats['ocr_seconds'] = time.perf_counter() - ocr_started
+
+    # 章ごとの翻訳・解析
+    analysis_started = time.perf_counter()
+    chapter_texts = {}
+    pending_chapters = []
+    for name, pages in chapters:
+        texts = [checkpoint.page_text(p) for p in pages]
+        chapter_texts[name] = "\n\n".join(t for t in texts if t)
+        if checkpoint.chapter_result(name) is not None:
+            stats['chapters_resumed'] += 1
+        elif any(t is None for t in texts):
+            # OCRに失敗したページを含む章は次回の実行に持ち越す
+            stats['chapters_failed'] += 1
+            print(f"章 {name}: 未処理ページがあるためスキップします")
+        else:
+            pending_chapters.append(name)
+
+    print(f"解析: {len(pending_chapters)}章を処理します（再開済み: {stats['chapters_resumed']}章）")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(analyze_chapter, chapter_texts[name], vocab_owner): name
+            for name in pending_chapters
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # 失敗した章は記録せず、次回の実行で再処理する
+                stats['chapters_failed'] += 1
+                print(f"章 {name}: 失敗 ({e})")
+                continue
+            record_known_words(vocab_owner, [w.get("word", "") for w in result['important_words']])
+            checkpoint.set_chapter(name, result)
+            stats['chapters_processed'] += 1
+            print(f"章 {name}: 完了")
+    stats['analysis_seconds'] = time.perf_counter() - analysis_started
+
+    # 章ごとのレポートと書籍全体のレポート
+    completed = []
+    for index, (name, _) in enumerate(chapters, 1):
+        result = checkpoint.chapter_result(name)
+        if result is None:
+            continue
+        completed.append((name, result))
+        doc_content = create_text_document(
+            chapter_texts[name], result['translated_text'],
+            result['important_words'], result['grammar_patterns']
+        )
+        write_report(os.path.join(output_dir, 'chapters', f"{index:03d}_{name}.txt"), doc_content)
+
+    if completed:
+        book_content = create_text_document(
+            "\n\n".join(f"【{name}】\n{chapter_texts[name]}" for name, _ in completed),
+            "\n\n".join(f"【{name}】\n{result['translated_text']}" for name, result in completed),
+            merge_words(result for _, result in completed),
+            [p for _, result in completed for p in result['grammar_patterns']]
+        )
+        write_report(os.path.join(output_dir, 'book.txt'), book_content)
+
+    stats['elapsed_seconds'] = time.perf_counter() - started
+    return stats
+
+def print_summary(stats):
+    elapsed = stats['elapsed_seconds']
+    pages_per_minute = stats['pages_processed'] / elapsed * 60 if elapsed > 0 else 0.0
+    print(f"""
+=========================================
+処理サマリー
+=========================================
+ページ: 全{stats['pages_total']} / 処理{stats['pages_processed']} / 再開{stats['pages_resumed']} / 失敗{stats['pages_failed']}
+章: 全{stats['chapters_total']} / 処理{stats['chapters_processed']} / 再開{stats['chapters_resumed']} / 失敗{stats['chapters_failed']}
+OCR時間: {stats['ocr_seconds']:.1f}秒
+解析時間: {stats['analysis_seconds']:.1f}秒
+総処理時間: {elapsed:.1f}秒
+スループット: {pages_per_minute:.1f}ページ/分
+""")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='ページ画像ディレクトリを一括で翻訳・解析します')
+    parser.add_argument('input_dir', help='ページ画像のディレクトリ')
+    parser.add_argument('-o', '--output-dir', default=None, help='出力ディレクトリ（既定: <input_dir>_output）')
+    parser.add_argument('-w', '--workers', type=int, default=4, help='並列ワーカー数')
+    parser.add_argument('--pages-per-chapter', type=int, default=20, help='直下のページ画像を章に分割するページ数')
+    parser.add_argument('--user-id', default=None, help='既知語彙インデックスのユーザーID')
+    parser.add_argument('--book-id', default=None, help='既知語彙インデックスの本ID')
+    args = parser.parse_args(argv)
+
+    if not GEMINI_API_KEY:
+        print("❌ GEMINI_API_KEY が設定されていません", file=sys.stderr)
+        return 1
+    if not os.path.isdir(args.input_dir):
+        print(f"❌ ディレクトリが見つかりません: {args.input_dir}", file=sys.stderr)
+        return 1
+
+    output_dir = args.output_dir or args.input_dir.rstrip(os.sep) + '_output'
+    print(f"開始: {datetime.now().strftime('%Y年%m月%d日 %H:%M')}")
+    stats = run_batch(
+        args.input_dir, output_dir, max(1, args.workers), max(1, args.pages_per_chapter),
+        vocabulary_key(args.user_id, args.book_id)
+    )
+    print_summary(stats)
+    print(f"レポート出力先: {output_dir}")
+    return 0 if stats['pages_failed'] == 0 and stats['chapters_failed'] == 0 else 2
+
+if __name__ == '__main__':
+    sys.exit(main())